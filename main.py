@@ -6,14 +6,18 @@ Task:     update statistics related to “Allgemeine Stimmberechtigung” in Ger
 See also: https://de.wikipedia.org/wiki/Benutzer:MisterSynergy/Stimmberechtigung
 """
 
-from datetime import datetime, timedelta
-from math import ceil as math_ceil
+from concurrent.futures import ThreadPoolExecutor
+from csv import QUOTE_NONNUMERIC
+from datetime import datetime
+from functools import lru_cache
+from io import StringIO
 from os.path import expanduser
 from time import gmtime, strftime, time
-from typing import Any, Optional, Union
+from typing import Optional, Union
 
 import mariadb
 import matplotlib.pyplot as plt
+from dateutil.relativedelta import relativedelta
 import pandas as pd
 import pywikibot as pwb
 
@@ -38,13 +42,11 @@ class Replica:
             database='dewiki_p',
             default_file=f'{expanduser("~")}/replica.my.cnf'
         )
-        self.cursor = self.replica.cursor(dictionary=True)
 
     def __enter__(self):
-        return self.cursor
+        return self.replica
 
     def __exit__(self, exc_type, exc_val, exc_tb):
-        self.cursor.close()
         self.replica.close()
 
 
@@ -73,145 +75,80 @@ class Plot:
         plt.close(self.fig)
 
 
-def query_dewiki(query:str) -> list[dict[str, Any]]:
-    with Replica() as db_cursor:
-        db_cursor.execute(query)
-        result = db_cursor.fetchall()
-
-    return result
-
-
 def query_dewiki_to_dataframe(query:str) -> pd.DataFrame:
-    result = query_dewiki(query)
-
-    df = pd.DataFrame(
-        data=result
-    )
+    with Replica() as db_connection:
+        df = pd.read_sql(query, db_connection, coerce_float=False)
 
     return df
 
 
-def first_query(minor_timestamp:int) -> pd.DataFrame:
+def combined_query(minor_timestamp:int, first_edit_timestamp:int) -> pd.DataFrame:
     query = f"""SELECT
   user_id,
   CONVERT(user_name USING utf8) AS user_name,
   user_editcount,
   CONVERT(user_registration USING utf8) AS user_registration,
-  COUNT(rev_id) AS user_editcount_ns0_last_year
+  CAST(SUM(page_namespace=0 AND rev_timestamp>{minor_timestamp:d}) AS SIGNED) AS user_editcount_ns0_last_year,
+  CAST(SUM(page_namespace=0) AS SIGNED) AS user_editcount_ns0_all_time
 FROM
   revision_userindex
     JOIN page ON rev_page=page_id
     JOIN actor_revision ON rev_actor=actor_id
     JOIN user ON actor_user=user_id
 WHERE
-  page_namespace=0
-  AND rev_timestamp>{minor_timestamp:d}
-  AND user_editcount>={NS0_EDITS_ALL:d}
+  user_editcount>={NS0_EDITS_ALL:d}
+  AND NOT EXISTS (SELECT 1 FROM user_groups WHERE ug_user=user_id AND ug_group='bot')
 GROUP BY
   user_id,
   user_editcount,
   user_registration
 HAVING
-  user_editcount_ns0_last_year>={NS0_EDITS_MINOR:d}"""
+  user_editcount_ns0_last_year>={NS0_EDITS_MINOR:d}
+  AND user_editcount_ns0_all_time>={NS0_EDITS_ALL:d}
+  AND MIN(rev_timestamp)<={first_edit_timestamp:d}"""
 
     return query_dewiki_to_dataframe(query)
 
 
-def second_query() -> pd.DataFrame:
-    query = 'SELECT ug_user FROM user_groups WHERE ug_group="bot"'
-
-    return query_dewiki_to_dataframe(query)
-
+def get_first_timestamps(user_ids:list[int]) -> pd.Series:
+    if len(user_ids) == 0:
+        return pd.Series(dtype='datetime64[ns]')
 
-def third_query(first_edit_timestamp:int) -> pd.DataFrame:
     query = f"""SELECT
-  DISTINCT user_id
+  actor_user,
+  CONVERT(MIN(rev_timestamp) USING utf8) AS min_rev_timestamp
 FROM
   revision_userindex
-    JOIN actor_revision ON actor_id=rev_actor
-    JOIN user ON actor_user=user_id
-WHERE
-  user_editcount>={NS0_EDITS_ALL:d}
-  AND rev_timestamp<={first_edit_timestamp:d}"""
-
-    return query_dewiki_to_dataframe(query)
-
-
-def fourth_query() -> pd.DataFrame:
-    query = f"""SELECT
-  user_id,
-  COUNT(rev_id) AS user_editcount_ns0_all_time
-FROM
-  revision_userindex
-    JOIN page ON rev_page=page_id
-    JOIN actor_revision ON actor_id=rev_actor
-    JOIN user ON actor_user=user_id
+    JOIN actor_revision ON rev_actor=actor_id
 WHERE
-  page_namespace=0
-  AND user_editcount>={NS0_EDITS_ALL:d}
+  actor_user IN ({','.join(f'{user_id:d}' for user_id in user_ids)})
 GROUP BY
-  user_id"""
-
-    return query_dewiki_to_dataframe(query)
-
-
-def get_first_timestamp(user_id:int) -> pd._libs.tslibs.timestamps.Timestamp:
-    query = f"""SELECT
-      CONVERT(MIN(rev_timestamp) USING utf8) AS min_rev_timestamp
-    FROM
-      revision_userindex
-        JOIN actor_revision ON rev_actor=actor_id
-    WHERE
-      actor_user={user_id:d}"""
-
-    result = query_dewiki(query)
+  actor_user"""
 
-    if len(result) == 0 or len(result[0]) == 0:
-        raise RuntimeWarning()
+    df = query_dewiki_to_dataframe(query)
 
-    dt = pd.to_datetime(
-        arg=int(result[0].get('min_rev_timestamp', 0)),
+    return pd.to_datetime(
+        df.set_index('actor_user')['min_rev_timestamp'],
         format='%Y%m%d%H%M%S'
     )
 
-    return dt
-
-
-def get_pseudo_registration(tpl:tuple[int, pd._libs.tslibs.timestamps.Timestamp]) -> pd._libs.tslibs.timestamps.Timestamp:
-    user_id, registration = tpl
-    if not isinstance(registration, pd._libs.tslibs.nattype.NaTType):
-        return registration
-
-    return get_first_timestamp(user_id)
-
-
-def calc_minor_timestamp_classical() -> int:
-    return int(f'{int(strftime("%Y"))-MINOR_TIME:4d}{strftime("%m%d%H%M%S")}')
-
 
 def calc_minor_timestamp_precise(ts:float) -> int:
     t_now = datetime.fromtimestamp(ts)
-    delta = timedelta(days=MINOR_TIME*365)
-
-    return int((t_now - delta).strftime('%Y%m%d%H%M%S'))
-
-
-def calc_first_edit_timestamp_classical() -> int:
-    first_edit_month = int(strftime('%m')) - FIRST_EDIT_TIME
-    first_edit_year = int(strftime('%Y'))
-    if first_edit_month < 1:
-        first_edit_month += 12
-        first_edit_year -= 1
-    first_edit_timestamp = int(f'{first_edit_year:4d}{first_edit_month:02d}{strftime("%d%H%M%S")}')
 
-    return first_edit_timestamp
+    return int((t_now - relativedelta(years=MINOR_TIME)).strftime('%Y%m%d%H%M%S'))
 
 
 def calc_first_edit_timestamp_precise(ts:float) -> int:
     t_now = datetime.fromtimestamp(ts)
-    delta = timedelta(days=FIRST_EDIT_TIME*30)
 
-    return int((t_now - delta).strftime('%Y%m%d%H%M%S'))
+    return int((t_now - relativedelta(months=FIRST_EDIT_TIME)).strftime('%Y%m%d%H%M%S'))
+
+
+@lru_cache(maxsize=None)
+def load_template(path:str) -> str:
+    with open(path, mode='r', encoding='utf8') as file_handle:
+        return file_handle.read()
 
 
 def save_to_wiki(page_title:str, wikitext:str, append:bool=False) -> None:
@@ -234,39 +171,24 @@ def get_final_dataframe(t_start:float, dump_df:bool=False, verbose:bool=False) -
     minor_timestamp = calc_minor_timestamp_precise(t_start)
     first_edit_timestamp = calc_first_edit_timestamp_precise(t_start)
 
-    #### first query
-    df1 = first_query(minor_timestamp)
-    t_query1 = time()
-    if verbose is True:
-        print(f'Found {df1.shape[0]} users with {NS0_EDITS_MINOR}+ ns0 edits during past {MINOR_TIME}' \
-              f' year(s), and {NS0_EDITS_ALL}+ edits in total ({t_query1-t_start:.0f} s)')
-
-    #### second query
-    df2 = second_query()
-    t_query2 = time()
-    if verbose is True:
-        print(f'Found {df2.shape[0]} users with botflag ({t_query2-t_query1:.0f} s)')
-
-    #### third query
-    df3 = third_query(first_edit_timestamp)
-    t_query3 = time()
-    if verbose is True:
-        print(f'Found {df3.shape[0]} users with first edit more than {FIRST_EDIT_TIME} month(s) ago,' \
-              f' and {NS0_EDITS_ALL}+ edits in total ({t_query3-t_query2:.0f} s)')
+    #### single server-side query for all eligibility criteria
+    users_with_stimmberechtigung = combined_query(minor_timestamp, first_edit_timestamp)
+
+    users_with_stimmberechtigung = users_with_stimmberechtigung.astype(
+        {
+            'user_id' : 'int32',
+            'user_editcount' : 'int32',
+            'user_editcount_ns0_last_year' : 'int32',
+            'user_editcount_ns0_all_time' : 'int32'
+        },
+        copy=False
+    )
 
-    #### fourth query
-    df4 = fourth_query()
     if verbose is True:
-        print(f'Found {df4.shape[0]} users with {NS0_EDITS_ALL}+ ns0 edits ({time()-t_query3:.0f} s)')
-
-    #### combine everything into a final dataframe
-    users_with_stimmberechtigung = df1.loc[~df1['user_id'].isin(df2['ug_user'])].merge(
-        right=df3,
-        on='user_id'
-    ).merge(
-        right=df4.loc[df4['user_editcount_ns0_all_time']>=NS0_EDITS_ALL],
-        on='user_id'
-    )
+        print(f'Found {users_with_stimmberechtigung.shape[0]} non-bot users with' \
+              f' {NS0_EDITS_MINOR}+ ns0 edits during past {MINOR_TIME} year(s),' \
+              f' {NS0_EDITS_ALL}+ ns0 edits in total, and first edit more than' \
+              f' {FIRST_EDIT_TIME} month(s) ago ({time()-t_start:.0f} s)')
 
     if dump_df is True:
         users_with_stimmberechtigung.to_csv(
@@ -279,11 +201,15 @@ def get_final_dataframe(t_start:float, dump_df:bool=False, verbose:bool=False) -
         format='%Y%m%d%H%M%S'
     )
 
-    users_with_stimmberechtigung['pseudo_registration'] = users_with_stimmberechtigung[
-        [ 'user_id', 'registration' ]
-    ].apply(
-        axis=1,
-        func=get_pseudo_registration
+    missing_ids = users_with_stimmberechtigung.loc[
+        users_with_stimmberechtigung['registration'].isna(),
+        'user_id'
+    ].tolist()
+    first_edit_timestamps = get_first_timestamps(missing_ids)
+
+    users_with_stimmberechtigung['pseudo_registration'] = users_with_stimmberechtigung['registration'].where(
+        users_with_stimmberechtigung['registration'].notna(),
+        users_with_stimmberechtigung['user_id'].map(first_edit_timestamps)
     )
 
     if verbose is True:
@@ -307,15 +233,8 @@ def get_final_dataframe_testing() -> pd.DataFrame:
             'user_editcount_ns0_last_year',
             'user_editcount_ns0_all_time'
         ],
-        dtype={
-            'unnamed' : int,
-            'user_id' : int,
-            'user_name' : str,
-            'user_editcount' : int,
-            'user_registration' : float,
-            'user_editcount_ns0_last_year' : int,
-            'user_editcount_ns0_all_time' : int
-        }
+        engine='pyarrow',
+        dtype_backend='pyarrow'
     )
 
     users_with_stimmberechtigung['registration'] = pd.to_datetime(
@@ -327,76 +246,103 @@ def get_final_dataframe_testing() -> pd.DataFrame:
 
 
 def accounts_by_registration_year(df:pd.DataFrame, dump_df_to_wiki:bool=True, save_image:bool=False) -> None:
-    tmp = df['user_id'].groupby(df['pseudo_registration'].dt.year).count().reset_index()
+    tmp = df.groupby(df['pseudo_registration'].dt.year, observed=True).size().rename('cnt').reset_index()
 
     if dump_df_to_wiki is True:
-        wikitext_data = 'year,cnt,series\n'
-        for elem in tmp.itertuples():
-            wikitext_data += f'{int(elem.pseudo_registration):d},{elem.user_id},"accounts_by_year"\n'
+        buffer = StringIO()
+        buffer.write('year,cnt,series\n')
+        tmp.assign(
+            pseudo_registration=tmp['pseudo_registration'].astype(int),
+            series='accounts_by_year'
+        ).to_csv(
+            buffer,
+            header=False,
+            index=False,
+            columns=[ 'pseudo_registration', 'cnt', 'series' ],
+            quoting=QUOTE_NONNUMERIC
+        )
 
-        save_to_wiki(f'{SUBPAGE_TITLE_BASE}account_registration_year/data', wikitext_data)
+        save_to_wiki(f'{SUBPAGE_TITLE_BASE}account_registration_year/data', buffer.getvalue())
 
     if save_image is True:
         with Plot(filename='accounts_by_registration_year') as ax:
-            tmp.plot(x='pseudo_registration', y='user_id', kind='scatter', ax=ax)
+            tmp.plot(x='pseudo_registration', y='cnt', kind='scatter', ax=ax)
 
             ax.set_xlabel('Anmeldejahr')
             ax.set_ylabel('Accounts mit "Allgemeiner Stimmberechtigung"')
             _, xmax, _, ymax = ax.axis()
             tick_years = 3
-            ax.set_xticks(range(2001, math_ceil(xmax/tick_years)*tick_years+1, tick_years))
+            ax.set_xticks(range(2001, (int(xmax)+tick_years-1)//tick_years*tick_years+1, tick_years))
             ax.set(xlim=(2000, xmax), ylim=(0, ymax*1.1))
 
 
 def accounts_by_editcount(df:pd.DataFrame, dump_df_to_wiki:bool=True, save_image:bool=False) -> None:
-    tmp = df['user_id'].groupby(df['user_editcount']).count().reset_index()
+    tmp = df.groupby('user_editcount', observed=True).size().rename('cnt').reset_index()
 
     if dump_df_to_wiki is True:
-        wikitext = 'editcount,cnt,series\n'
-        for elem in tmp.itertuples():
-            wikitext += f'{elem.user_editcount},{elem.user_id},"user_editcount"\n'
+        buffer = StringIO()
+        buffer.write('editcount,cnt,series\n')
+        tmp.assign(series='user_editcount').to_csv(
+            buffer,
+            header=False,
+            index=False,
+            columns=[ 'user_editcount', 'cnt', 'series' ],
+            quoting=QUOTE_NONNUMERIC
+        )
 
-        save_to_wiki(f'{SUBPAGE_TITLE_BASE}account_editcount/data', wikitext)
+        save_to_wiki(f'{SUBPAGE_TITLE_BASE}account_editcount/data', buffer.getvalue())
 
     if save_image is True:
         with Plot('accounts_by_editcount') as ax:
-            tmp.plot(x='user_editcount', y='user_id', kind='scatter', ax=ax, logy=True, logx=True)
+            tmp.plot(x='user_editcount', y='cnt', kind='scatter', ax=ax, logy=True, logx=True)
 
             ax.set_xlabel('Beitragszahl')
             ax.set_ylabel('Accounts mit "Allgemeiner Stimmberechtigung"')
 
 
 def accounts_by_editcount_ns0(df:pd.DataFrame, dump_df_to_wiki:bool=True, save_image:bool=False) -> None:
-    tmp = df['user_id'].groupby(df['user_editcount_ns0_all_time']).count().reset_index()
+    tmp = df.groupby('user_editcount_ns0_all_time', observed=True).size().rename('cnt').reset_index()
 
     if dump_df_to_wiki is True:
-        wikitext = 'editcount,cnt,series\n'
-        for elem in tmp.itertuples():
-            wikitext += f'{elem.user_editcount_ns0_all_time},{elem.user_id},"user_editcount_ns0_all_time"\n'
+        buffer = StringIO()
+        buffer.write('editcount,cnt,series\n')
+        tmp.assign(series='user_editcount_ns0_all_time').to_csv(
+            buffer,
+            header=False,
+            index=False,
+            columns=[ 'user_editcount_ns0_all_time', 'cnt', 'series' ],
+            quoting=QUOTE_NONNUMERIC
+        )
 
-        save_to_wiki(f'{SUBPAGE_TITLE_BASE}account_editcount_ns0/data', wikitext)
+        save_to_wiki(f'{SUBPAGE_TITLE_BASE}account_editcount_ns0/data', buffer.getvalue())
 
     if save_image is True:
         with Plot(filename='accounts_by_editcount_ns0') as ax:
-            tmp.plot(x='user_editcount_ns0_all_time', y='user_id', kind='scatter', ax=ax, logy=True, logx=True)
+            tmp.plot(x='user_editcount_ns0_all_time', y='cnt', kind='scatter', ax=ax, logy=True, logx=True)
 
             ax.set_xlabel('Beitragszahl (Hauptnamensraum)')
             ax.set_ylabel('Accounts mit "Allgemeiner Stimmberechtigung"')
 
 
 def accounts_by_editcount_ns0_past_year(df:pd.DataFrame, dump_df_to_wiki:bool=True, save_image:bool=False) -> None:
-    tmp = df['user_id'].groupby(df['user_editcount_ns0_last_year']).count().reset_index()
+    tmp = df.groupby('user_editcount_ns0_last_year', observed=True).size().rename('cnt').reset_index()
 
     if dump_df_to_wiki is True:
-        wikitext = 'ecitcount,cnt,series\n'
-        for elem in tmp.itertuples():
-            wikitext += f'{elem.user_editcount_ns0_last_year},{elem.user_id},"user_editcount_ns0_last_year"\n'
+        buffer = StringIO()
+        buffer.write('ecitcount,cnt,series\n')
+        tmp.assign(series='user_editcount_ns0_last_year').to_csv(
+            buffer,
+            header=False,
+            index=False,
+            columns=[ 'user_editcount_ns0_last_year', 'cnt', 'series' ],
+            quoting=QUOTE_NONNUMERIC
+        )
 
-        save_to_wiki(f'{SUBPAGE_TITLE_BASE}account_editcount_ns0_past_year/data', wikitext)
+        save_to_wiki(f'{SUBPAGE_TITLE_BASE}account_editcount_ns0_past_year/data', buffer.getvalue())
 
     if save_image is True:
         with Plot(filename='accounts_by_editcount_ns0_past_year') as ax:
-            tmp.plot(x='user_editcount_ns0_last_year', y='user_id', kind='scatter', ax=ax, logy=True, logx=True)
+            tmp.plot(x='user_editcount_ns0_last_year', y='cnt', kind='scatter', ax=ax, logy=True, logx=True)
 
             ax.set_xlabel('Beitragszahl (Hauptnamensraum, letztes Jahr)')
             ax.set_ylabel('Accounts mit "Allgemeiner Stimmberechtigung"')
@@ -417,30 +363,24 @@ def get_statistics_data(df:pd.DataFrame) -> dict[str, Union[float, int, str]]:
 
     statistics:dict[str, Union[float, int, str]] = {}
     for key in keys:
-        s = str(df[key].describe())
-        for line in s.split('\n'):
-            if line.startswith('Name: '):
-                continue
-
-            measure, value = line.split(maxsplit=1)
-
+        described = df[key].describe()
+        for measure, value in described.items():
             if key in [ 'registration', 'pseudo_registration' ]:
                 if measure == 'count':
-                    statistics[f'{key}_{measure}'] = int(float(value))
+                    statistics[f'{key}_{measure}'] = int(value)
                 else:
-                    statistics[f'{key}_{measure}'] = value[:10]
+                    statistics[f'{key}_{measure}'] = pd.Timestamp(value).strftime('%Y-%m-%d')
             else:
                 if measure in [ 'mean', 'std' ]:
                     statistics[f'{key}_{measure}'] = float(value)
                 else:
-                    statistics[f'{key}_{measure}'] = int(float(value))
+                    statistics[f'{key}_{measure}'] = int(value)
 
     return statistics
 
 
 def get_misc_statistics(df:pd.DataFrame) -> str:
-    with open(STATISTICS_TEMPLATE, mode='r', encoding='utf8') as file_handle:
-        template = file_handle.read()
+    template = load_template(STATISTICS_TEMPLATE)
 
     statistics_data = get_statistics_data(df)
     table_wikitext = template.format(**statistics_data)
@@ -449,8 +389,7 @@ def get_misc_statistics(df:pd.DataFrame) -> str:
 
 
 def update_main_report(df:pd.DataFrame, t_start:float) -> None:
-    with open(REPORT_TEMPLATE, mode='r', encoding='utf8') as file_handle:
-        template = file_handle.read()
+    template = load_template(REPORT_TEMPLATE)
 
     params:dict[str, str] = {
         'cnt' : str(df.shape[0]),
@@ -470,9 +409,15 @@ def main() -> None:
     users_with_stimmberechtigung = get_final_dataframe(t_start, dump_df=True, verbose=True)
     #users_with_stimmberechtigung = get_final_dataframe_testing()
 
-    update_main_report(users_with_stimmberechtigung, t_start)  # 1 edit
-    append_current_value(t_start, users_with_stimmberechtigung)  # 1 edit
-    accounts_by_registration_year(users_with_stimmberechtigung)  # 1 edits
+    # three edits to independent pages; pywikibot's throttle gates the rate globally
+    with ThreadPoolExecutor(max_workers=3) as executor:
+        futures = [
+            executor.submit(update_main_report, users_with_stimmberechtigung, t_start),
+            executor.submit(append_current_value, t_start, users_with_stimmberechtigung),
+            executor.submit(accounts_by_registration_year, users_with_stimmberechtigung)
+        ]
+        for future in futures:
+            future.result()
 
     # TODO: currently unused; need to look at binning in order to have useful numbers
     #accounts_by_editcount(users_with_stimmberechtigung)  # 1 edit